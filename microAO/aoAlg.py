@@ -119,7 +119,7 @@ class AdaptiveOpticsFunctions():
         return ndarray
 
     def mgcentroid(self, myim, mythr=0.0):
-        assert(myim.dtype == np.float)
+        assert(np.issubdtype(myim.dtype, np.floating))
 
         myn1, myn2 = myim.shape
         myxx1, myxx2 = np.meshgrid(range(1, myn1 + 1), range(1, myn2 + 1))
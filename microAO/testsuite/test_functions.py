@@ -18,56 +18,100 @@
 ## You should have received a copy of the GNU General Public License
 ## along with Microscope.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import unittest
 import numpy as np
+import scipy.fft
 import aotools
 import microAO.aoAlg as AO
-from scipy.signal import gaussian
 from skimage.restoration import unwrap_phase
 
+def empty_aligned(shape, dtype, alignment=64):
+  #C-contiguous uninitialised array whose data starts on an alignment byte
+  #boundary, so FFT and vectorised kernels can use full-width aligned loads
+  dtype = np.dtype(dtype)
+  nbytes = int(np.prod(shape)) * dtype.itemsize
+  buffer = np.empty(nbytes + alignment, dtype=np.uint8)
+  offset = -buffer.ctypes.data % alignment
+  return buffer[offset:offset + nbytes].view(dtype).reshape(shape)
+
+def phase_from_zernikes(zcoeffs, size):
+  #Like aotools.phaseFromZernikes, but only evaluates the modes with a
+  #non-zero coefficient rather than every mode up to len(zcoeffs)
+  modes = np.flatnonzero(zcoeffs)
+  basis = aotools.zernikeArray([int(mode) + 1 for mode in modes], size)
+  phase = empty_aligned((size, size), np.float32)
+  phase[:] = np.tensordot(zcoeffs[modes], basis, axes=1)
+  return phase
+
+#Non-zero region of a Fourier filter and the (y, x) index of its top left corner
+FilterPatch = collections.namedtuple("FilterPatch", ["values", "corner"])
+
 class TestAOFunctions(unittest.TestCase):
 
-  def _gaussian_funcion(self, x, offset, normalising, mean, std_dev):
+  @staticmethod
+  def _gaussian_funcion(x, offset, normalising, mean, std_dev):
     return (offset - normalising) + (normalising * np.exp((-(x - mean) ** 2) / (2 * std_dev ** 2)))
 
-  def _construct_interferogram(self):
-    mid_y = self.radius
-    mid_x = self.radius
-    interferogram_shape = ((self.radius*2),(self.radius*2))
-    stripes_ft = np.zeros(interferogram_shape)
-    stripes_ft[mid_y-self.true_y_freq, mid_x-self.true_x_freq] = 25
-    stripes_ft[mid_y, mid_x] = 50
-    stripes_ft[mid_y+self.true_y_freq, mid_x+self.true_x_freq] = 25
-
-    stripes_shift = np.fft.fftshift(stripes_ft)
-    stripes = np.fft.fft2(stripes_shift).real
-
-    test_interferogram = stripes * self.true_mask
+  @staticmethod
+  def _gaussian_window(num_points, std_dev):
+    #Symmetric Gaussian window, as returned by scipy.signal.windows.gaussian
+    n = np.arange(num_points) - (num_points - 1) / 2.0
+    return np.exp(-0.5 * (n / std_dev) ** 2)
+
+  @classmethod
+  def _construct_interferogram(cls):
+    diameter = cls.radius * 2
+    #Build the spectrum directly in the unshifted rfft layout, which only
+    #holds the non-negative x frequencies. Impulses whose conjugate falls in
+    #the dropped half are restored by irfft2 from Hermitian symmetry.
+    stripes_ft = np.zeros((diameter, cls.radius + 1), dtype=np.complex64)
+    stripes_ft[0, 0] = 50
+    for y_freq, x_freq in ((-cls.true_y_freq, -cls.true_x_freq),
+                           (cls.true_y_freq, cls.true_x_freq)):
+      if x_freq % diameter <= cls.radius:
+        stripes_ft[y_freq % diameter, x_freq % diameter] += 25
+
+    stripes = scipy.fft.irfft2(stripes_ft, s=(diameter, diameter), norm="forward", workers=-1)
+
+    test_interferogram = empty_aligned(stripes.shape, np.float32)
+    np.multiply(stripes, cls.true_mask, out=test_interferogram)
     return test_interferogram
 
-  def _construct_true_mask(self):
-    diameter = self.radius * 2
-    mask = np.sqrt((np.arange(-self.radius,self.radius)**2).reshape((
-        diameter,1)) + (np.arange(-self.radius,self.radius)**2)) < self.radius
+  @classmethod
+  def _construct_true_mask(cls):
+    #Compare squared radii in int32 rather than taking a float64 sqrt
+    coords = np.arange(-cls.radius, cls.radius, dtype=np.int32)
+    r_squared = coords[:, np.newaxis]**2 + coords[np.newaxis, :]**2
+    mask = empty_aligned(r_squared.shape, bool)
+    np.less(r_squared, cls.radius**2, out=mask)
     return mask
 
-  def _construct_true_fft_filter(self):
-    diameter = self.radius * 2
-    fft_filter = np.zeros((diameter,diameter))
+  @classmethod
+  def _construct_true_fft_filter(cls):
+    diameter = cls.radius * 2
     gauss_dim = int(diameter*(5.0/16.0))
     FWHM = int((3.0/8.0) * gauss_dim)
     stdv = FWHM/np.sqrt(8 * np.log(2))
-    x = gaussian(gauss_dim,stdv)
-    gauss = np.outer(x,x.T)
-    gauss = gauss*(gauss>(np.max(x)*np.min(x)))
-
-    fft_filter[(self.radius-self.true_y_freq-int(gauss_dim/2)):
-               (self.radius-self.true_y_freq+int(gauss_dim/2)),
-               (self.radius-self.true_x_freq-int(gauss_dim/2)):
-               (self.radius-self.true_x_freq+int(gauss_dim/2))] = gauss
+    x = cls._gaussian_window(gauss_dim, stdv).astype(np.float32)
+    gauss = x[:, np.newaxis] * x[np.newaxis, :]
+    np.putmask(gauss, gauss <= (np.max(x)*np.min(x)), 0)
+
+    corner = (cls.radius-cls.true_y_freq-int(gauss_dim/2),
+              cls.radius-cls.true_x_freq-int(gauss_dim/2))
+    return FilterPatch(gauss, corner)
+
+  @classmethod
+  def _place_fft_filter(cls, patch):
+    diameter = cls.radius * 2
+    fft_filter = np.zeros((diameter,diameter), dtype=patch.values.dtype)
+    y_min, x_min = patch.corner
+    fft_filter[y_min:y_min+patch.values.shape[0],
+               x_min:x_min+patch.values.shape[1]] = patch.values
     return fft_filter
 
-  def _construct_single_mode_measurements(self, shape, z_min, z_max, num_mes, true_max):
+  @classmethod
+  def _construct_single_mode_measurements(cls, shape, z_min, z_max, num_mes, true_max):
     stack = np.ones((num_mes, shape[0], shape[1]))
     z_measurements = np.linspace(z_min, z_max, num_mes)
 
@@ -76,12 +120,13 @@ class TestAOFunctions(unittest.TestCase):
     min_x = (stack.shape[2] // 2) - int(stack.shape[2] * 0.2)
     max_x = (stack.shape[2] // 2) + int(stack.shape[2] * 0.2)
     for ii in range(num_mes):
-      stack[ii, min_y:max_y, min_x:max_x] = self._gaussian_funcion(z_measurements[ii],
-                                                   100, 100, true_max, ((z_max-z_min)/4))
+      stack[ii, min_y:max_y, min_x:max_x] = cls._gaussian_funcion(z_measurements[ii],
+                                                  100, 100, true_max, ((z_max-z_min)/4))
 
     return stack
 
-  def _construct_multiple_mode_measurements(self, shape, z_min, z_max, num_mes, all_true_max, noll_zernike):
+  @classmethod
+  def _construct_multiple_mode_measurements(cls, shape, z_min, z_max, num_mes, all_true_max, noll_zernike):
     stack = np.ones((num_mes*len(noll_zernike), shape[0], shape[1]))
     z_measurements = np.linspace(z_min, z_max, num_mes)
 
@@ -92,90 +137,121 @@ class TestAOFunctions(unittest.TestCase):
 
     for ii in range(len(noll_zernike)):
         for jj in range(num_mes):
-            stack[jj+(num_mes*ii), min_y:max_y, min_x:max_x] = self._gaussian_funcion(z_measurements[jj],
-                                                                                      100, 100,
-                                                                                      all_true_max[noll_zernike[ii]-1],
-                                                                                      ((z_max - z_min) / 4))
+            stack[jj+(num_mes*ii), min_y:max_y, min_x:max_x] = cls._gaussian_funcion(z_measurements[jj],
+                                                                                     100, 100,
+                                                                                     all_true_max[noll_zernike[ii]-1],
+                                                                                     ((z_max - z_min) / 4))
 
     return stack
 
+  @classmethod
+  def _get_AO_fft_filter(cls):
+    #make_fft_filter is a full-size FFT that only a couple of tests need, so
+    #build it on first use and share the result with later tests
+    if cls._AO_fft_filter is None:
+      fft_filter = AO.AdaptiveOpticsFunctions().make_fft_filter(image = cls.test_inter, region=None)
+      fft_filter.setflags(write=False)
+      cls._AO_fft_filter = fft_filter
+    return cls._AO_fft_filter
+
+  @classmethod
+  def setUpClass(cls):
+    #Initialize necessary variables. The fixtures are shared by every test
+    #and made read-only, so a test which needs to modify one must copy it.
+    cls.planned_n_actuators = 10
+    cls.num_poke_steps = 5
+    cls.pattern = np.zeros((cls.planned_n_actuators))
+    cls.radius = 1024
+    cls.nzernike = 10
+    cls.true_x_freq = 350
+    cls.true_y_freq = 0
+    cls.true_mask = cls._construct_true_mask()
+    cls.test_inter = cls._construct_interferogram()
+    cls.true_fft_patch = cls._construct_true_fft_filter()
+    cls.true_control_matrix = np.diag(np.ones(cls.nzernike))
+    AO_func = AO.AdaptiveOpticsFunctions()
+    cls.AO_mask = AO_func.make_mask(cls.radius)
+    cls._AO_fft_filter = None
+    cls.true_ac_applied = np.linspace(0, 1, cls.nzernike)
+    x = cls._gaussian_window(100, 10)
+    cls.true_metric_single_measure = x[:, np.newaxis] * x[np.newaxis, :]
+    cls.true_fourier_metric = 5700
+    cls.true_fourier_power_metric = 373000
+    cls.true_contrast_metric = 771000
+    cls.true_gradient_metric = 0.00537
+    cls.true_second_moment_metric = 83
+    cls.test_NA = 1.1
+    cls.test_wavelength = 500 * (10**-9)
+    cls.test_pixel_size = 0.1193 * (10 ** -6)
+
+    cls.true_num_mes = 15
+    cls.true_z_min = -1
+    cls.true_z_max = 1
+    cls.true_max_mode_z = 0.5
+    cls.true_single_mode_measurements = cls._construct_single_mode_measurements((100, 100), cls.true_z_min,
+                                                                                cls.true_z_max, cls.true_num_mes,
+                                                                                cls.true_max_mode_z)
+
+    cls.true_noll_zernike = np.asarray([1, 3, 5])
+    cls.true_max_modes_z = np.zeros(cls.planned_n_actuators)
+    cls.true_max_modes_z[cls.true_noll_zernike[0] - 1] = -0.35
+    cls.true_max_modes_z[cls.true_noll_zernike[1] - 1] = 0.3
+    cls.true_max_modes_z[cls.true_noll_zernike[2] - 1] = -0.55
+
+    cls.true_multi_mode_measurements = cls._construct_multiple_mode_measurements((100,100), cls.true_z_min,
+                                                                                 cls.true_z_max, cls.true_num_mes,
+                                                                                 cls.true_max_modes_z,
+                                                                                 cls.true_noll_zernike)
+
+    for fixture in (cls.pattern, cls.true_mask, cls.test_inter, cls.true_fft_patch.values,
+                    cls.true_control_matrix, cls.AO_mask, cls.true_ac_applied,
+                    cls.true_metric_single_measure, cls.true_single_mode_measurements,
+                    cls.true_noll_zernike, cls.true_max_modes_z, cls.true_multi_mode_measurements):
+      fixture.setflags(write=False)
+
+    for fixture in (cls.true_mask, cls.test_inter):
+      assert fixture.flags['C_CONTIGUOUS'] and fixture.ctypes.data % 64 == 0
+
   def setUp(self):
-    #Initialize necessary variables
-    self.planned_n_actuators = 10
-    self.num_poke_steps = 5
-    self.pattern = np.zeros((self.planned_n_actuators))
-    self.radius = 1024
-    self.nzernike = 10
-    self.true_x_freq = 350
-    self.true_y_freq = 0
-    self.true_mask = self._construct_true_mask()
-    self.test_inter = self._construct_interferogram()
-    self.true_fft_filter = self._construct_true_fft_filter()
-    self.true_control_matrix = np.diag(np.ones(self.nzernike))
+    #AdaptiveOpticsFunctions holds state (metric, mask, filter, control
+    #matrix) so each test gets a fresh instance primed with the shared mask
     self.AO_func = AO.AdaptiveOpticsFunctions()
-    self.AO_mask = self.AO_func.make_mask(self.radius)
-    self.AO_fft_filter = self.AO_func.make_fft_filter(image = self.test_inter, region=None)
-    self.true_ac_applied = np.linspace(0, 1, self.nzernike)
-    self.true_metric_single_measure = np.outer(gaussian(100,10),gaussian(100,10).T)
-    self.true_fourier_metric = 5700
-    self.true_fourier_power_metric = 373000
-    self.true_contrast_metric = 771000
-    self.true_gradient_metric = 0.00537
-    self.true_second_moment_metric = 83
-    self.test_NA = 1.1
-    self.test_wavelength = 500 * (10**-9)
-    self.test_pixel_size = 0.1193 * (10 ** -6)
-
-    self.true_num_mes = 15
-    self.true_z_min = -1
-    self.true_z_max = 1
-    self.true_max_mode_z = 0.5
-    self.true_single_mode_measurements = self._construct_single_mode_measurements((100, 100), self.true_z_min,
-                                                                                  self.true_z_max, self.true_num_mes,
-                                                                                  self.true_max_mode_z)
-
-    self.true_noll_zernike = np.asarray([1, 3, 5])
-    self.true_max_modes_z = np.zeros(self.planned_n_actuators)
-    self.true_max_modes_z[self.true_noll_zernike[0] - 1] = -0.35
-    self.true_max_modes_z[self.true_noll_zernike[1] - 1] = 0.3
-    self.true_max_modes_z[self.true_noll_zernike[2] - 1] = -0.55
-
-    self.true_multi_mode_measurements = self._construct_multiple_mode_measurements((100,100), self.true_z_min,
-                                                                                   self.true_z_max, self.true_num_mes,
-                                                                                   self.true_max_modes_z,
-                                                                                   self.true_noll_zernike)
+    self.AO_func.set_mask(self.AO_mask)
 
   def test_make_mask(self):
     test_mask = self.AO_func.make_mask(self.radius)
     np.testing.assert_array_equal(self.true_mask, test_mask)
 
   def test_fourier_filter(self):
-    test_fft_filter = self.AO_func.make_fft_filter(image = self.test_inter, region=None)
+    test_fft_filter = self._get_AO_fft_filter()
 
-    true_pos = np.asarray([self.true_y_freq, self.true_x_freq])
-    max_pos = abs(np.asarray(np.where(test_fft_filter == np.max(test_fft_filter))) - 1024)
-    test_pos = np.mean(max_pos, axis=1)
-    np.testing.assert_almost_equal(test_pos[0], true_pos[0], decimal=0)
-    np.testing.assert_almost_equal(test_pos[1], true_pos[1], decimal=0)
+    max_y, max_x = np.unravel_index(np.argmax(test_fft_filter), test_fft_filter.shape)
+    np.testing.assert_almost_equal(abs(max_y - self.radius), self.true_y_freq, decimal=0)
+    np.testing.assert_almost_equal(abs(max_x - self.radius), self.true_x_freq, decimal=0)
 
   def test_mgcentroid(self):
-    g0, g1 = np.asarray(self.AO_func.mgcentroid(self.true_fft_filter)) - self.radius
+    g0, g1 = np.asarray(self.AO_func.mgcentroid(self._place_fft_filter(self.true_fft_patch))) - self.radius
     np.testing.assert_almost_equal(abs(g0), self.true_x_freq, decimal=0)
     np.testing.assert_almost_equal(abs(g1), self.true_y_freq, decimal=0)
 
   def test_unwrap_interferometry(self):
-    zcoeffs_in = np.zeros(self.planned_n_actuators)
+    zcoeffs_in = np.zeros(self.planned_n_actuators, dtype=np.float32)
     zcoeffs_in[2] = 1
-    aberration_angle = aotools.phaseFromZernikes(zcoeffs_in, self.test_inter.shape[1])
-    aberration_phase = (1 + np.cos(aberration_angle) + (1j * np.sin(aberration_angle))) * self.true_mask
+    aberration_angle = phase_from_zernikes(zcoeffs_in, self.test_inter.shape[1])
+    aberration_phase = np.exp(1j * aberration_angle)
+    aberration_phase += 1
+    aberration_phase *= self.true_mask
     test_phase = self.test_inter * aberration_phase
+    self.AO_func.set_fft_filter(self._get_AO_fft_filter())
     aberration = unwrap_phase(np.arctan2(aberration_phase.imag,aberration_phase.real))
 
     test_aberration = self.AO_func.unwrap_interferometry(image=test_phase)
     #Test that the test aberrations isn't all 0s
     np.testing.assert_equal(np.not_equal(np.sum(test_aberration),0), True)
-    ab_ratio_mean = np.mean(test_aberration[aberration != 0]/aberration[aberration != 0])
-    ab_ratio_var = np.var(test_aberration[aberration != 0]/aberration[aberration != 0])
+    nonzero = aberration != 0
+    ab_ratio = test_aberration[nonzero]/aberration[nonzero]
+    ab_ratio_mean = np.mean(ab_ratio)
+    ab_ratio_var = np.var(ab_ratio)
 
     #Test that there is a sensible ratio between the test and true aberration
     #and that the variance of ratio is small
@@ -184,16 +260,15 @@ class TestAOFunctions(unittest.TestCase):
 
   def test_aqcuire_zernike_modes(self):
     diameter = 128
-    zcoeffs_in = np.zeros(self.nzernike)
+    zcoeffs_in = np.zeros(self.nzernike, dtype=np.float32)
     zcoeffs_in[5] = 1
-    img = np.zeros((diameter,diameter))
-    img[:,:] = aotools.phaseFromZernikes(zcoeffs_in, diameter)
+    img = phase_from_zernikes(zcoeffs_in, diameter)
 
-    zc_out = np.zeros((5,self.nzernike))
-    for ii in range(5):
-      zc_out[ii, :] = self.AO_func.get_zernike_modes(img, self.nzernike)
-      max_z_mode = np.where(zc_out[0,:] == np.max(zc_out[0,:]))[0][0]
-      np.testing.assert_equal(max_z_mode, 5)
+    #get_zernike_modes is deterministic, so repeated calls on the same image
+    #would only recompute the same coefficients
+    zc_out = self.AO_func.get_zernike_modes(img, self.nzernike)
+    max_z_mode = int(np.argmax(zc_out))
+    np.testing.assert_equal(max_z_mode, 5)
 
     z_diff = zcoeffs_in-zc_out
     z_mean_diff = np.mean(z_diff)
@@ -269,8 +344,6 @@ class TestAOFunctions(unittest.TestCase):
                                                                  zernike_amplitudes, wavelength=self.test_wavelength,
                                                                  NA=self.test_NA, pixel_size=self.test_pixel_size)
 
-    print(amplitude_present)
-    print(self.true_max_mode_z)
     np.testing.assert_almost_equal(-1 * amplitude_present, self.true_max_mode_z, decimal=2)
 
   def test_get_zernike_modes_sensorless(self):
@@ -285,8 +358,6 @@ class TestAOFunctions(unittest.TestCase):
                                                      self.true_noll_zernike, wavelength=self.test_wavelength,
                                                      NA=self.test_NA, pixel_size=self.test_pixel_size)
 
-    print(coef)
-    print(self.true_max_modes_z)
     for noll_ind in self.true_noll_zernike:
       np.testing.assert_almost_equal(-1 * coef[noll_ind-1], self.true_max_modes_z[noll_ind-1],decimal=2)
 